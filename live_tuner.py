@@ -1,18 +1,47 @@
 import sys
+import math
 import time
+import queue
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
 import numpy as np
 import sounddevice as sd
-from basic_pitch.inference import Model, ICASSP_2022_MODEL_PATH
+import onnxruntime as ort
+from scipy.signal import butter, sosfilt
+from basic_pitch import FilenameSuffix, build_icassp_2022_model_path
 
 # --- CONFIGURATION ---
 SAMPLE_RATE = 22050
 HOP_SIZE = 2048         # The amount of new audio we process per step
 WINDOW_LENGTH = 43844   # The context length required by the model (~2 seconds)
+INFERENCE_STRIDE = 2    # Run the model every Nth block (2 -> ~185ms cadence)
+INFERENCE_PROCESSES = 0 # >0 runs inference in a process pool with several windows in
+                        # flight (higher throughput for logging, at the cost of latency)
+
+# ONNX Runtime execution providers in order of preference; unavailable ones are skipped
+ONNX_PROVIDERS = [
+    "CoreMLExecutionProvider",  # macOS (Apple Neural Engine / GPU)
+    "DmlExecutionProvider",     # Windows DirectML (needs onnxruntime-directml)
+    "CUDAExecutionProvider",
+    "CPUExecutionProvider",
+]
 
 # Sensitivity
 NOTE_THRESHOLD = 0.4        # Confidence to sustain a note
 ONSET_THRESHOLD = 0.5       # Confidence to detect a NEW hit (attack)
 MIN_VOLUME_THRESHOLD = 0.001 # Microphone gate (raise this if noise triggers notes)
+WINDOW_RMS_TOLERANCE = 0.01  # Relative window RMS change that counts as "unchanged"
+MAX_SKIPPED_WINDOWS = 1      # Unchanged windows skipped in a row before one is re-checked
+GATE_HIGHPASS_HZ = 40        # Rumble/DC below this is ignored by the volume gate
+
+LOG_FLUSH_INTERVAL = 0.05    # Seconds between terminal flushes from the printer thread
+LOG_BUFFER_SIZE = 256        # Pending messages kept if the console stalls (oldest dropped)
+
+# Only the newest model frames are inspected (approx last 50ms of audio)
+FOCUS_WINDOW_SIZE = 5
 
 NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
 
@@ -21,6 +50,9 @@ def midi_to_note_name(midi_number):
     note_index = midi_number % 12
     return f"{NOTE_NAMES[note_index]}{octave}"
 
+# Names of the 88 piano keys (MIDI 21 to 108), indexed by key position
+NOTE_NAMES_88 = tuple(midi_to_note_name(i + 21) for i in range(88))
+
 def select_microphone():
     print("\n--- Available Audio Devices ---")
     devices = sd.query_devices()
@@ -33,21 +65,77 @@ def select_microphone():
     except:
         return None
 
-def print_volume_bar(volume):
-    """Prints a visual volume bar to help debug microphone levels."""
-    bar_len = 30
-    fill = int(min(volume * 10, 1.0) * bar_len)
-    bar = '#' * fill + '-' * (bar_len - fill)
-    sys.stdout.write(f"\rVolume: [{bar}] {volume:.3f} ")
-    sys.stdout.flush()
+VOLUME_BAR_LEN = 30
+# Every possible bar, indexed by fill level, so the callback doesn't build them
+VOLUME_BARS = tuple('#' * fill + '-' * (VOLUME_BAR_LEN - fill) for fill in range(VOLUME_BAR_LEN + 1))
+
+def format_volume_bar(volume):
+    """Formats a visual volume bar to help debug microphone levels."""
+    bar = VOLUME_BARS[int(min(volume * 10, 1.0) * VOLUME_BAR_LEN)]
+    return f"\rVolume: [{bar}] {volume:.3f} "
+
+class OnnxModel:
+    """basic-pitch's ONNX model on the best available ONNX Runtime provider.
+
+    basic_pitch.inference.Model always opens ONNX files on the CPU provider, so
+    this builds the session itself and mirrors that class's predict() mapping.
+    """
+    INPUT_NAME = "serving_default_input_2:0"
+    OUTPUT_NAMES = {
+        'note': "StatefulPartitionedCall:1",
+        'onset': "StatefulPartitionedCall:2",
+        'contour': "StatefulPartitionedCall:0",
+    }
+
+    def __init__(self, model_path):
+        available = ort.get_available_providers()
+        providers = [p for p in ONNX_PROVIDERS if p in available]
+        self.session = ort.InferenceSession(str(model_path), providers=providers)
+
+    def predict(self, x):
+        outputs = self.session.run(list(self.OUTPUT_NAMES.values()), {self.INPUT_NAME: x})
+        return dict(zip(self.OUTPUT_NAMES, outputs))
+
+def load_model():
+    """Loads basic-pitch's bundled ONNX model."""
+    return OnnxModel(build_icassp_2022_model_path(FilenameSuffix.onnx))
+
+_model = None
+
+def get_model():
+    """Returns the process-wide model, loading it on first use."""
+    global _model
+    if _model is None:
+        _model = load_model()
+    return _model
+
+# --- PROCESS POOL WORKERS (INFERENCE_PROCESSES > 0) ---
+def _init_inference_process():
+    # Ctrl+C is handled by the main process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    get_model()
+
+def _process_ready():
+    return True
+
+def _predict_in_process(audio_buffer):
+    return get_model().predict(audio_buffer.reshape(1, -1, 1))
 
 def main():
     device_id = select_microphone()
     print("\nLoading Model (this may take a moment)...")
+    model = None
+    pool = None
     try:
-        model = Model(ICASSP_2022_MODEL_PATH)
+        if INFERENCE_PROCESSES > 0:
+            pool = ProcessPoolExecutor(INFERENCE_PROCESSES, initializer=_init_inference_process)
+            pool.submit(_process_ready).result()  # Surfaces model load errors now
+        else:
+            model = get_model()
     except Exception as e:
         print(f"Error loading model: {e}")
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
         return
 
     print("\nSuccess! Logging notes...")
@@ -56,43 +144,100 @@ def main():
     print("-" * 50)
 
     # BUFFERS
-    audio_buffer = np.zeros((1, WINDOW_LENGTH, 1), dtype=np.float32)
+    # Ring buffer twice the window length: new audio is appended at write_pos and
+    # the newest WINDOW_LENGTH samples are exposed as a view, so the window only
+    # has to be copied back to the head once every few blocks instead of rolled.
+    ring_buffer = np.zeros(WINDOW_LENGTH * 2, dtype=np.float32)
+    write_pos = WINDOW_LENGTH
+    window_energy = 0.0  # Running sum of squares over the current window
+
+    # The gate measures volume after a high-pass filter, so DC offset and HVAC
+    # rumble don't open it. Only the gate is filtered; the model gets raw audio.
+    # Kept in float32 like the stream so sosfilt stays single precision. sosfilt
+    # has no out= parameter, so it still returns a new 2048-sample output and a
+    # new state array each block; this is the callback's one remaining allocation.
+    gate_sos = butter(2, GATE_HIGHPASS_HZ, 'highpass', fs=SAMPLE_RATE, output='sos').astype(np.float32)
+    gate_zi = np.zeros((gate_sos.shape[0], 2), dtype=np.float32)  # Filter state carried across blocks
+
+    # SCRATCH
+    # Everything the inference thread writes per window is allocated here once,
+    # so the hot path does not allocate (and cannot trigger GC).
+    scratch = SimpleNamespace(
+        notes_max=np.empty(88, dtype=np.float32),   # Per-key max over the focus window
+        onsets_max=np.empty(88, dtype=np.float32),
+        sustaining=np.empty(88, dtype=bool),
+        attacks=np.empty(88, dtype=bool),
+        changed=np.empty(88, dtype=bool),
+    )
+    # Window snapshots are flat like the ring buffer and only viewed as the
+    # model's (1, WINDOW_LENGTH, 1) input shape at predict time. They cycle
+    # between the callback, the queue and the inference thread; three buffers
+    # means one is always free for the callback, plus one per pool process so
+    # windows in flight don't starve it.
+    free_buffers = queue.SimpleQueue()
+    for _ in range(3 + INFERENCE_PROCESSES):
+        free_buffers.put(np.empty(WINDOW_LENGTH, dtype=np.float32))
     
     # STATE TRACKING
-    active_notes = {}  # Dict mapping midi_number -> start_time
-    instance_id = 0
-    start_time_ref = time.time()
+    active_mask = np.zeros(88, dtype=bool)  # Which piano keys are currently sounding
+    active_ts = np.zeros(88, dtype=np.float64)  # Start time per key (valid where active_mask)
+    start_time_ref = time.monotonic()
+    gate_open = False  # Whether the last block was above the volume gate
+    tick = 0           # Blocks received, used to stride inference
+    last_win_rms = -1.0  # Window RMS at the last dispatched inference
+    skipped_windows = 0  # Unchanged windows skipped since then
 
-    def callback(indata, frames, time_info, status):
-        nonlocal audio_buffer, active_notes, instance_id
-        
-        if status:
-            print(status, file=sys.stderr)
+    # LOGGING
+    # The audio callback and inference thread never write to the terminal
+    # themselves (a slow console could block them); they queue text for a
+    # printer thread that batches writes and flushes every LOG_FLUSH_INTERVAL.
+    # The buffer is bounded: if the console stalls, the oldest messages are
+    # dropped rather than piling up.
+    log_buffer = deque(maxlen=LOG_BUFFER_SIZE)
 
-        new_data = indata.astype(np.float32)
-        
-        # 1. Volume Gate & Debug
-        volume = np.sqrt(np.mean(new_data**2))
-        print_volume_bar(volume)
+    def log(text, stream=sys.stdout):
+        log_buffer.append((stream, text))
 
-        # Shift Buffer
-        audio_buffer = np.roll(audio_buffer, -frames, axis=1)
-        audio_buffer[0, -frames:, :] = new_data
-        
-        # Skip AI processing if silence (saves CPU)
-        if volume < MIN_VOLUME_THRESHOLD:
-            # If we were tracking notes, clear them because of silence
-            if active_notes:
-                print(f"\n[Silence] All notes ended.")
-                active_notes = {}
-            return
+    def printer():
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            if not log_buffer:
+                continue
+            while True:
+                try:
+                    stream, text = log_buffer.popleft()
+                except IndexError:
+                    break
+                stream.write(text)
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+    # THREADING
+    # The audio callback only buffers samples and hands window snapshots to the
+    # inference thread. The queue holds a single window: if inference falls
+    # behind, the stale window is dropped in favour of the newest one.
+    # A None item tells the inference thread that the input went silent.
+    inference_queue = queue.Queue(maxsize=1)
 
-        # 2. Run AI Inference
+    def post_window(item):
         try:
-            output = model.predict(audio_buffer)
-        except Exception:
-            return
+            inference_queue.put_nowait(item)
+        except queue.Full:
+            try:
+                stale = inference_queue.get_nowait()
+                if stale is not None:
+                    free_buffers.put(stale)
+            except queue.Empty:
+                pass
+            inference_queue.put_nowait(item)
+
+    def handle_silence():
+        # If we were tracking notes, clear them because of silence
+        if active_mask.any():
+            log("\n[Silence] All notes ended.\n")
+            active_mask[:] = False
 
+    def process_output(output):
         # Output format is dictionary with keys: 'note', 'onset', 'contour'
         # Shape: (batch, time_frames, 88_notes)
         note_probs = output['note']
@@ -103,62 +248,201 @@ def main():
 
         # --- KEY FIX: TEMPORAL SLICING ---
         # Instead of looking at the whole 2-second buffer, look only at the 
-        # last 3 frames (approx last 30-50ms) which corresponds to the NEW audio.
-        # We assume 3 frames is enough to be stable but fast enough to catch rapid notes.
-        focus_window_size = 5 
+        # last FOCUS_WINDOW_SIZE frames which correspond to the NEW audio.
+        # This is enough to be stable but fast enough to catch rapid notes.
         
-        # Get max probability in the "Now" window
-        current_notes_max = np.max(note_probs[0, -focus_window_size:, :], axis=0)
-        current_onsets_max = np.max(onset_probs[0, -focus_window_size:, :], axis=0)
+        # Get max probability in the "Now" window (reduced into reused buffers).
+        # Consecutive inferences are at least INFERENCE_STRIDE * HOP_SIZE samples
+        # (~16 model frames) apart, so their focus windows never share frames and
+        # there is no running max to carry over; the 5x88 reduction is recomputed.
+        np.max(note_probs[0, -FOCUS_WINDOW_SIZE:, :], axis=0, out=scratch.notes_max)
+        np.max(onset_probs[0, -FOCUS_WINDOW_SIZE:, :], axis=0, out=scratch.onsets_max)
+
+        # One clock read per window keeps all timestamps in this pass consistent
+        t_now = time.monotonic()
 
         # 3. Process Notes
-        # We scan all 88 piano keys (MIDI 21 to 108)
-        detected_this_frame = set()
-
-        for i in range(88):
-            midi_num = i + 21
-            prob_note = current_notes_max[i]
-            prob_onset = current_onsets_max[i]
-            
-            # CONDITION 1: Note is loud enough to be considered "Sustaining"
-            is_sustaining = prob_note > NOTE_THRESHOLD
-            
-            # CONDITION 2: Note is being "Attacked" (Hit freshly)
-            is_attack = prob_onset > ONSET_THRESHOLD
-
-            if is_sustaining:
-                detected_this_frame.add(midi_num)
-                
-                # LOGIC: If note is already active, but we detect a NEW ATTACK, restart it.
-                if midi_num in active_notes and is_attack:
-                    # Note re-articulation (e.g. playing the same chord twice quickly)
-                    old_timestamp = active_notes[midi_num]
-                    # Only re-trigger if some time has passed (debounce fast glitches, e.g., 100ms)
-                    if (time.time() - old_timestamp) > 0.1:
-                        print(f"\nRE-TRIGGER: {midi_to_note_name(midi_num)}")
-                        active_notes[midi_num] = time.time()
-                
-                # LOGIC: New Note
-                elif midi_num not in active_notes:
-                    current_ms = int((time.time() - start_time_ref) * 1000)
-                    active_notes[midi_num] = time.time()
-                    print(f"\n[{current_ms}ms] Note ON: {midi_to_note_name(midi_num)}")
+        # Threshold all 88 piano keys (MIDI 21 to 108) in one pass
+        # CONDITION 1: Note is loud enough to be considered "Sustaining"
+        sustaining = np.greater(scratch.notes_max, NOTE_THRESHOLD, out=scratch.sustaining)
+        # CONDITION 2: Note is being "Attacked" (Hit freshly)
+        attacks = np.greater(scratch.onsets_max, ONSET_THRESHOLD, out=scratch.attacks)
+
+        # Diff against the active keys so only changed keys are visited
+        # (for booleans, a > b is a & ~b without the temporary from ~b)
+        changed = scratch.changed
+        np.logical_and(sustaining, attacks, out=changed)
+        changed &= active_mask
+        retriggered = np.flatnonzero(changed)
+        np.greater(sustaining, active_mask, out=changed)
+        note_on = np.flatnonzero(changed)
+        np.greater(active_mask, sustaining, out=changed)
+        note_off = np.flatnonzero(changed)
+
+        # LOGIC: If note is already active, but we detect a NEW ATTACK, restart it.
+        for i in retriggered:
+            # Note re-articulation (e.g. playing the same chord twice quickly)
+            # Only re-trigger if some time has passed (debounce fast glitches, e.g., 100ms)
+            if (t_now - active_ts[i]) > 0.1:
+                log(f"\nRE-TRIGGER: {NOTE_NAMES_88[i]}\n")
+                active_ts[i] = t_now
+
+        # LOGIC: New Note
+        if len(note_on):
+            current_ms = int((t_now - start_time_ref) * 1000)
+            active_ts[note_on] = t_now
+            for i in note_on:
+                log(f"\n[{current_ms}ms] Note ON: {NOTE_NAMES_88[i]}\n")
 
         # 4. Handle Note Offs
         # If a note was active but is no longer detected in the current frame
-        active_ids = list(active_notes.keys())
-        for midi_num in active_ids:
-            if midi_num not in detected_this_frame:
-                print(f"\nNote OFF: {midi_to_note_name(midi_num)}")
-                del active_notes[midi_num]
+        for i in note_off:
+            log(f"\nNote OFF: {NOTE_NAMES_88[i]}\n")
+
+        # Keys that turned on or off are exactly the sustaining set now
+        np.copyto(active_mask, sustaining)
+
+    def inference_worker():
+        while True:
+            audio_buffer = inference_queue.get()
+            if audio_buffer is None:
+                handle_silence()
+                continue
+            # 2. Run AI Inference
+            try:
+                output = model.predict(audio_buffer.reshape(1, -1, 1))
+            except Exception:
+                continue
+            finally:
+                free_buffers.put(audio_buffer)
+            process_output(output)
+
+    # In pool mode the dispatcher submits windows as they arrive and the result
+    # thread consumes futures in submission order, so notes stay in time order
+    # while several windows are inferred concurrently.
+    pending = queue.Queue(maxsize=max(INFERENCE_PROCESSES, 1))
+
+    def dispatch_worker():
+        while True:
+            audio_buffer = inference_queue.get()
+            if audio_buffer is None:
+                pending.put(None)
+                continue
+            future = pool.submit(_predict_in_process, audio_buffer)
+            # The buffer is pickled lazily, so it is only reusable once the call is done
+            future.add_done_callback(lambda _, buffer=audio_buffer: free_buffers.put(buffer))
+            pending.put(future)
+
+    def result_worker():
+        while True:
+            future = pending.get()
+            if future is None:
+                handle_silence()
+                continue
+            try:
+                output = future.result()
+            except Exception:
+                continue
+            process_output(output)
+
+    def callback(indata, frames, time_info, status):
+        nonlocal write_pos, window_energy, gate_zi, gate_open, tick, last_win_rms, skipped_windows
+        
+        if status:
+            log(f"{status}\n", sys.stderr)
+
+        # The stream delivers float32, so the block is read in place
+        incoming = indata[:, 0]
+        # Sum of squares in a single dot product (no squared temporary)
+        incoming_energy = float(np.dot(incoming, incoming))
+        
+        # 1. Volume Gate & Debug
+        filtered, gate_zi = sosfilt(gate_sos, incoming, zi=gate_zi)
+        volume = math.sqrt(float(np.dot(filtered, filtered)) / frames)
+        # Only the latest meter reading matters, so don't let it crowd out
+        # note events while the printer is behind
+        if len(log_buffer) < LOG_BUFFER_SIZE // 2:
+            log(format_volume_bar(volume))
+
+        # Update the window energy incrementally: add the incoming block and
+        # subtract the samples about to fall out of the window
+        outgoing = ring_buffer[write_pos - WINDOW_LENGTH:write_pos - WINDOW_LENGTH + frames]
+        window_energy += incoming_energy - float(np.dot(outgoing, outgoing))
+
+        # Append to Ring Buffer
+        compacted = write_pos + frames > ring_buffer.shape[0]
+        if compacted:
+            keep = WINDOW_LENGTH - frames
+            ring_buffer[:keep] = ring_buffer[write_pos - keep:write_pos]
+            write_pos = keep
+        ring_buffer[write_pos:write_pos + frames] = incoming
+        write_pos += frames
+        window = ring_buffer[write_pos - WINDOW_LENGTH:write_pos]
+        if compacted:
+            # Resync occasionally so float rounding can't accumulate
+            window_energy = float(np.dot(window, window))
+        
+        # Skip AI processing if silence (saves CPU)
+        if volume < MIN_VOLUME_THRESHOLD:
+            if gate_open:
+                post_window(None)
+                gate_open = False
+                last_win_rms = -1.0
+                skipped_windows = 0
+            return
+        gate_open = True
+
+        # The window is kept fresh every block, but the model only runs on strided ticks
+        tick += 1
+        if tick % INFERENCE_STRIDE:
+            return
+
+        # While notes are sounding, a window whose RMS barely moved will most
+        # likely give the same notes again, so skip it. The RMS can't see a pitch
+        # change at the same level, so only MAX_SKIPPED_WINDOWS are skipped in a
+        # row. (active_mask belongs to the inference thread; a stale read only
+        # costs or saves a single window.)
+        win_rms = math.sqrt(max(window_energy, 0.0) / WINDOW_LENGTH)
+        unchanged = abs(win_rms - last_win_rms) <= WINDOW_RMS_TOLERANCE * last_win_rms
+        if unchanged and skipped_windows < MAX_SKIPPED_WINDOWS and active_mask.any():
+            skipped_windows += 1
+            return
+
+        # Snapshot the window so the ring buffer can keep moving during inference
+        try:
+            snapshot = free_buffers.get_nowait()
+        except queue.Empty:
+            return
+        last_win_rms = win_rms
+        skipped_windows = 0
+        np.copyto(snapshot, window)
+        post_window(snapshot)
+
+    threading.Thread(target=printer, daemon=True).start()
+    if pool is not None:
+        threading.Thread(target=dispatch_worker, daemon=True).start()
+        threading.Thread(target=result_worker, daemon=True).start()
+    else:
+        threading.Thread(target=inference_worker, daemon=True).start()
+
+    # The main thread just sleeps on an event until Ctrl+C sets it
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda *args: stop_event.set())
+    # Before Python 3.14 a blocking wait can't be interrupted on Windows, so
+    # wake once a second there to let the signal handler run
+    wait_timeout = 1.0 if sys.platform == "win32" else None
 
     try:
         # Reduced blocksize slightly for better responsiveness (optional)
         with sd.InputStream(device=device_id, channels=1, samplerate=22050, 
-                            blocksize=HOP_SIZE, callback=callback):
-            while True: sd.sleep(1000)
-    except KeyboardInterrupt:
+                            blocksize=HOP_SIZE, dtype='float32', latency='low',
+                            callback=callback):
+            while not stop_event.wait(wait_timeout):
+                pass
         print("\nLog Stopped.")
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file